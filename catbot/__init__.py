@@ -1,42 +1,238 @@
+import hashlib
 import json
 import logging
+import mmap
+import os
+import re
+import shutil
+import socket
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from typing import Callable, Any, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = True) -> bytes:
+    """
+    Serialize obj into utf-8 json bytes, keeping non-ascii characters as they are.
+    :param indent: indent with 2 spaces if True, otherwise output compact json for requests
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _digest(content) -> bytes:
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+def _load_json_file(path: str) -> tuple[Any, bytes]:
+    """
+    Load a json file. Files of 1 MiB or larger are memory-mapped and parsed without copying them into a bytes object
+    when orjson is available.
+    :return: a tuple. The first element is the deserialized content. The second is the digest of the file content.
+    """
+    with open(path, 'rb') as f:
+        if orjson is None or os.fstat(f.fileno()).st_size < 1 << 20:
+            content = f.read()
+            return _json_loads(content), _digest(content)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view), _digest(view)
+
+
+def _write_atomic(path: str, content: bytes):
+    """
+    Write content to a temporary file and then replace path with it, so that path is never left half-written.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# Actions called often enough by bots that requests for them are prepared in advance
+_PREPARED_ACTIONS = (
+    'getUpdates',
+    'sendMessage',
+    'editMessageText',
+    'forwardMessage',
+    'answerCallbackQuery',
+    'deleteMessage',
+    'getChat',
+    'getChatMember',
+    'restrictChatMember',
+    'kickChatMember',
+    'unbanChatMember',
+    'approveChatJoinRequest',
+    'declineChatJoinRequest',
+    'getFile',
+)
+
+# Permissions to send messages of any kind, taken away by Bot.silence_chat_member and given back by
+# Bot.lift_restrictions
+_SEND_PERMISSIONS = (
+    'can_send_messages',
+    'can_send_audios',
+    'can_send_documents',
+    'can_send_photos',
+    'can_send_videos',
+    'can_send_video_notes',
+    'can_send_voice_notes',
+    'can_send_polls',
+    'can_send_other_messages',
+    'can_add_web_page_previews',
+)
+_SILENCED_PERMISSIONS = dict.fromkeys(_SEND_PERMISSIONS, False)
+_LIFTED_PERMISSIONS = dict.fromkeys(_SEND_PERMISSIONS, True)
+
+
+# Entity type -> (opening tag, closing tag) in html_formatted_text of messages
+_HTML_TAGS = {
+    'bold': ('<b>', '</b>'),
+    'italic': ('<i>', '</i>'),
+    'underline': ('<u>', '</u>'),
+    'strikethrough': ('<s>', '</s>'),
+    'spoiler': ('<tg-spoiler>', '</tg-spoiler>'),
+    'code': ('<code>', '</code>'),
+}
+
+
+# Entity type -> name of the entity list of messages
+_ENTITY_LISTS = {
+    'mention': 'mentions',
+    'hashtag': 'hashtags',
+    'cashtag': 'cashtags',
+    'bot_command': 'commands',
+    'url': 'links',
+    'bold': 'bolds',
+    'italic': 'italics',
+    'underline': 'underlines',
+    'strikethrough': 'strikethroughs',
+    'spoiler': 'spoilers',
+    'code': 'codes',
+    'text_link': 'text_links',
+    'text_mention': 'text_mention',
+}
+# Entity types that are formatted in html_formatted_text of messages
+_FORMATTED_ENTITIES = frozenset(_HTML_TAGS) | {'text_link', 'text_mention'}
+# Keys of which any one marks a message as forwarded
+_FORWARD_KEYS = ('forward_from', 'forward_sender_name', 'forward_from_chat', 'forward_from_message_id')
+# Shared by all messages without entities. Entity lists are empty tuples here, so they can not be appended to.
+_NO_ENTITIES = {name: () for name in _ENTITY_LISTS.values()} | {'leading_command': '', 'formatted': ()}
+
+
+def _entity_list(name: str) -> property:
+    return property(lambda self: self._entities[name])
+
+
+class _cached_slot:
+    """
+    Like functools.cached_property, but for classes with __slots__. The value is cached in the slot named
+    "_cached_" + name of the property, which the class must declare.
+    """
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.slot = None
+
+    def __set_name__(self, owner: type, name: str):
+        self.slot = owner.__dict__['_cached_' + name]
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:
+            value = self.func(instance)
+            self.slot.__set__(instance, value)
+            return value
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+
+class _TelegramAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose sockets do not wait to coalesce small requests (Nagle's algorithm) and are kept alive between
+    long polls.
+    """
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, 256 * 1024),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, 256 * 1024),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['socket_options'] = self.socket_options
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
 
 
 class User:
+    __slots__ = ('raw', 'id', 'is_bot', 'name', 'username', 'link')
+
     def __init__(self, user_json: dict):
         self.raw = user_json
         self.id: int = user_json['id']
         self.is_bot: bool = user_json['is_bot']
-        if 'last_name' in user_json:
-            self.name = f"{user_json['first_name']} {user_json['last_name']}"
-        else:
-            self.name = user_json['first_name']
-        if 'username' in user_json:
-            self.username: str = user_json['username']
-            self.link = 't.me/' + self.username
+        last_name = user_json.get('last_name')
+        if last_name is None:
+            self.name: str = user_json['first_name']
         else:
-            self.username = ''
-            self.link = ''
+            self.name: str = f"{user_json['first_name']} {last_name}"
+        self.username: str = user_json.get('username', '')
+        self.link = 't.me/' + self.username if self.username else ''
 
 
 class Bot(User):
     def __init__(self, config: dict = None, config_path: str = None):
+        # Digests of content last read from or written to config and record files. Unchanged content is not written
+        # again.
+        self._saved_config = b''
+        self._saved_record = b''
         if config_path is None:
             self.config = config
             self.config_path = ''
         else:
-            self.config = json.load(open(config_path, 'r', encoding='utf-8'))
+            self.config, self._saved_config = _load_json_file(config_path)
             self.config_path = config_path
         self.token: str = self.config['token']
         self.base_url = 'https://api.telegram.org/bot' + self.token + '/'
+        self._record_lock = threading.RLock()
+        # Path -> ((st_mtime_ns, st_size), deserialized content) of files read by secure_record_fetch
+        self._record_cache: dict[str, tuple[tuple[int, int], Any]] = {}
         if 'record' in self.config:
             try:
-                self.record = json.load(open(self.config['record'], 'r', encoding='utf-8'))
+                self.record, self._saved_record = _load_json_file(self.config['record'])
             except FileNotFoundError:
                 self.record = {}
         else:
@@ -46,9 +242,37 @@ class Bot(User):
             self.proxies = {'https': self.config['proxy']['proxy_url']}
         else:
             self.proxies = {}
-        get_me_resp = self.api('getMe', data={})
+        self.session = requests.Session()
+        self.session.mount('https://', _TelegramAdapter(
+            pool_connections=4,
+            pool_maxsize=32,
+            # Only failed connections are retried. API calls are POST requests, which urllib3 does not retry on error
+            # status codes, and downloads report a bad status as FilePathError.
+            max_retries=Retry(total=3, backoff_factor=0.2)
+        ))
+        # Frequent actions are prepared once and only get a new body on each call
+        self._prepared: dict[str, requests.PreparedRequest] = {
+            action: self.session.prepare_request(requests.Request(
+                'POST', self.base_url + action, headers={'Content-Type': 'application/json'}
+            )) for action in _PREPARED_ACTIONS
+        }
+        # URLs of other actions, filled as they are called
+        self._action_urls: dict[str, str] = {}
+        self._send_settings = self.session.merge_environment_settings(self.base_url, self.proxies, None, None, None)
+        # The getMe response is cached next to the record file, never in the record itself
+        self._identity_path = self.config['record'] + '.identity' if 'record' in self.config else ''
+        get_me_resp = self._cached_identity()
+        if get_me_resp is None:
+            get_me_resp = self.api('getMe', data={})
+            if self._identity_path:
+                try:
+                    _write_atomic(self._identity_path, _json_dumps({'identity': get_me_resp, 'ts': int(time.time())}))
+                except OSError:
+                    # Only a cache. The bot works without it.
+                    pass
 
         super().__init__(get_me_resp)
+        self._at_username = '@' + self.username
 
         self.can_join_groups: bool = get_me_resp['can_join_groups']
         self.can_read_all_group_messages: bool = get_me_resp['can_read_all_group_messages']
@@ -59,21 +283,107 @@ class Bot(User):
         self.member_status_tasks: list[tuple[Callable, Callable, dict]] = []
         self.my_member_status_tasks: list[tuple[Callable, Callable, dict]] = []
         self.chat_join_request_tasks: list[tuple[Callable, Callable, dict]] = []
+        # Command -> list of (action, action_kw, require_username). Commands are matched without a linear scan.
+        self._cmd_dispatch: dict[str, list[tuple[Callable, dict, bool]]] = {}
+
+        # Update type -> (class of the update object, name of the task list, function getting chat ID of the object)
+        self._dispatchers: dict[str, tuple[type, str, Callable[[Any], Any]]] = {
+            'message': (Message, 'msg_tasks', lambda msg: msg.chat.id),
+            'callback_query': (CallbackQuery, 'query_tasks',
+                               lambda query: query.msg.chat.id if query.msg else query.from_.id),
+            'chat_member': (ChatMemberUpdate, 'member_status_tasks', lambda update: update.chat.id),
+            'my_chat_member': (ChatMemberUpdate, 'my_member_status_tasks', lambda update: update.chat.id),
+            'chat_join_request': (ChatJoinRequestUpdate, 'chat_join_request_tasks', lambda update: update.chat.id),
+        }
+
+        self.executor = ThreadPoolExecutor(max_workers=self.config.get('workers', 32))
+        # If True, actions in the same chat run one after another in the order their updates arrive. Off by default,
+        # since a long action (e.g. one waiting for a user to verify) would hold back later updates of its chat.
+        self._ordered_chats: bool = self.config.get('ordered_chats', False)
+        # Pending actions of chats that have an action running, used when _ordered_chats is True
+        self._chat_queues: dict[int, deque[tuple[Callable, Any, dict]]] = {}
+        self._chat_queues_lock = threading.Lock()
+        # Chat ID -> earliest time.monotonic() at which the next part of a split message may be sent
+        self._send_slots: dict[Any, float] = {}
+        self._send_slots_lock = threading.Lock()
+
+    def _cached_identity(self, ttl: int = 86400) -> Optional[dict]:
+        """
+        Reuse the getMe response saved by a previous run within ttl seconds, so that restarting the bot does not wait
+        for a round trip to Telegram.
+        :return: the saved getMe response, or None if there is no valid one.
+        """
+        if not self._identity_path:
+            return None
+        try:
+            saved, _ = _load_json_file(self._identity_path)
+            identity, ts = saved['identity'], saved['ts']
+            # The token starts with the bot ID. Do not reuse the identity of another bot.
+            if time.time() - ts >= ttl or str(identity['id']) != self.token.split(':')[0]:
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return identity
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
         self.save_config_and_record()
+        self.session.close()
 
     def save_config_and_record(self):
         if self.config_path:
-            json.dump(self.config, open(self.config_path, 'w', encoding='utf-8'), indent=2, ensure_ascii=False)
-        if self.record:
-            json.dump(self.record, open(self.config['record'], 'w', encoding='utf-8'), indent=2, ensure_ascii=False)
+            content = _json_dumps(self.config)
+            digest = _digest(content)
+            if digest != self._saved_config:
+                _write_atomic(self.config_path, content)
+                self._saved_config = digest
+        with self._record_lock:
+            if self.record:
+                content = _json_dumps(self.record)
+                digest = _digest(content)
+                if digest != self._saved_record:
+                    _write_atomic(self.config['record'], content)
+                    self._saved_record = digest
+
+    def update_record(self, key: str, fn: Callable[[Any], Any], default: Any = None) -> Any:
+        """
+        Update a value in record while holding the record lock, so that read-modify-write updates from actions running
+        in different threads do not overwrite each other.
+        :param key: Name of the data in record
+        :param fn: A function that takes the current value (default if key is absent) and returns the new value.
+        :param default: Value passed to fn if key is not in record yet.
+        :return: the new value
+        """
+        with self._record_lock:
+            value = fn(self.record.get(key, default))
+            self.record[key] = value
+            return value
 
     def api(self, action: str, data: dict, timeout=60):
-        resp = requests.post(self.base_url + action, json=data, timeout=timeout, proxies=self.proxies).json()
+        if action in self._prepared:
+            req = self._prepared[action].copy()
+            req.prepare_body(_json_dumps(data, indent=False), None)
+            resp = self.session.send(req, timeout=timeout, **self._send_settings)
+        else:
+            url = self._action_urls.get(action)
+            if url is None:
+                url = self._action_urls[action] = self.base_url + action
+            if data:
+                resp = self.session.post(url, data=_json_dumps(data, indent=False), timeout=timeout,
+                                         proxies=self.proxies, headers={'Content-Type': 'application/json'})
+            else:
+                resp = self.session.post(url, timeout=timeout, proxies=self.proxies)
+        try:
+            resp = _json_loads(resp.content)
+        except ValueError as e:
+            # E.g. an html error page from a proxy. Raise it as a RequestException like Response.json() does, so that
+            # the polling loop logs it and continues.
+            raise requests.exceptions.JSONDecodeError(
+                getattr(e, 'msg', str(e)), getattr(e, 'doc', ''), getattr(e, 'pos', 0), response=resp
+            ) from e
         if not resp['ok']:
             raise APIError(f'API request "{action}" failed. {resp["description"]}')
 
@@ -82,27 +392,29 @@ class Bot(User):
     def get_updates(self, offset: int = 0, timeout: int = 60) -> list:
         update_data = {'offset': offset,
                        'timeout': timeout,
-                       'allowed_updates': [
-                           # Accept all updates, but only part of them are available in catbot
-                           'message',  # Available
-                           'edited_message',
-                           'channel_post',
-                           'edited_channel_post',
-                           'inline_query',
-                           'chosen_inline_result',
-                           'callback_query',  # Available
-                           'shipping_query',
-                           'pre_checkout_query',
-                           'poll',
-                           'poll_answer',
-                           'my_chat_member',
-                           'chat_member',  # Available
-                           'chat_join_request'  # Available
-                       ]}
+                       'allowed_updates': self._allowed_updates()}
         updates = self.api('getUpdates', update_data, timeout=timeout + 10)
         logging.debug(updates)
         return updates
 
+    def _allowed_updates(self) -> list[str]:
+        """
+        Only ask Telegram for update types that have tasks. Other types are dropped by Telegram server instead of being
+        sent to the bot and ignored. Computed on every call since tasks may be added at any time.
+        """
+        allowed_updates = []
+        if self.msg_tasks or self._cmd_dispatch:
+            allowed_updates.append('message')
+        if self.query_tasks:
+            allowed_updates.append('callback_query')
+        if self.member_status_tasks:
+            allowed_updates.append('chat_member')
+        if self.my_member_status_tasks:
+            allowed_updates.append('my_chat_member')
+        if self.chat_join_request_tasks:
+            allowed_updates.append('chat_join_request')
+        return allowed_updates
+
     def add_msg_task(
             self,
             criteria: Callable[["Message"], bool],
@@ -142,6 +454,38 @@ class Bot(User):
 
         return decorator
 
+    def command_task(self, cmd: str, require_username: bool = False):
+        """
+        Tag a function as action function for messages starting with a command. Faster than msg_task with
+        detect_command in criteria when many tasks are added, since commands are looked up in a dict instead of
+        calling every criteria function.
+        :param cmd: the command, e.g. "/start"
+        :param require_username: True if only commands with username of the bot are accepted, e.g. /start@somebot
+                                 False if both /start and /start@somebot are accepted
+        :return:
+        """
+
+        def decorator(action: Callable[["Message"], None]) -> Callable[["Message"], None]:
+            self._cmd_dispatch.setdefault(cmd, []).append((action, {}, require_username))
+            return action
+
+        return decorator
+
+    def _command_actions(self, msg: "Message") -> list[tuple[Callable, dict]]:
+        """
+        Find actions added by command_task for the command that msg starts with.
+        """
+        # Checked first so that bots without command tasks do not collect the entities of every message
+        if not self._cmd_dispatch or not msg._leading_command:
+            return []
+        cmd, _, username = msg._leading_command.partition('@')
+        if username and username != self.username:
+            return []
+        return [
+            (action, action_kw) for action, action_kw, require_username in self._cmd_dispatch.get(cmd, [])
+            if username or not require_username
+        ]
+
     def add_query_task(
             self,
             criteria: Callable[["CallbackQuery"], bool],
@@ -234,52 +578,81 @@ class Bot(User):
     def start(self, stop_event=None, print_log=False, timeout=60):
         old_updates = self.get_updates(offset=0, timeout=0)
         update_offset = old_updates[-1]['update_id'] + 1 if old_updates else 0
-        while stop_event is None or not stop_event.is_set():
-            try:
-                updates = self.get_updates(offset=update_offset, timeout=timeout)
-            except (APIError, requests.RequestException) as e:
-                logging.warning(e.args[0])
-                continue
+        # A short poll submitted when the last batch was (nearly) full, so that a backlog is fetched while the current
+        # batch is being dispatched. At most one is in flight to keep updates in order. It runs in its own thread
+        # instead of the worker pool, where it would wait behind the actions of the batch.
+        prefetch = None
+        poller = ThreadPoolExecutor(max_workers=1)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                try:
+                    if prefetch is not None:
+                        future, prefetch = prefetch, None
+                        updates = future.result()
+                    else:
+                        updates = self.get_updates(offset=update_offset, timeout=timeout)
+                except (APIError, requests.RequestException) as e:
+                    logging.warning(e.args[0])
+                    continue
 
-            for item in updates:
-                if print_log:
-                    print(item)
-                update_offset = item['update_id'] + 1
-                if 'message' in item:
-                    msg = Message(item['message'])
-                    for criteria, action, action_kw in self.msg_tasks:
-                        if criteria(msg):
-                            threading.Thread(target=action, args=(msg,), kwargs=action_kw).start()
-
-                elif 'callback_query' in item:
-                    query = CallbackQuery(item['callback_query'])
-                    if not hasattr(query, 'msg'):
+                if len(updates) >= 95:
+                    prefetch = poller.submit(self.get_updates, offset=updates[-1]['update_id'] + 1, timeout=0)
+
+                for item in updates:
+                    if print_log:
+                        print(item)
+                    update_offset = item['update_id'] + 1
+                    for update_type in item:
+                        if update_type in self._dispatchers:
+                            break
+                    else:
                         continue
-                    for criteria, action, action_kw in self.query_tasks:
-                        if criteria(query):
-                            threading.Thread(target=action, args=(query,), kwargs=action_kw).start()
-
-                elif 'chat_member' in item:
-                    member_update = ChatMemberUpdate(item['chat_member'])
-                    for criteria, action, action_kw in self.member_status_tasks:
-                        if criteria(member_update):
-                            threading.Thread(target=action, args=(member_update,), kwargs=action_kw).start()
-                elif 'my_chat_member' in item:
-                    member_update = ChatMemberUpdate(item['my_chat_member'])
-                    for criteria, action, action_kw in self.my_member_status_tasks:
-                        if criteria(member_update):
-                            threading.Thread(target=action, args=(member_update,), kwargs=action_kw).start()
-
-                elif 'chat_join_request' in item:
-                    join_request_update = ChatJoinRequestUpdate(item['chat_join_request'])
-                    for criteria, action, action_kw in self.chat_join_request_tasks:
-                        if criteria(join_request_update):
-                            threading.Thread(target=action, args=(join_request_update,), kwargs=action_kw).start()
-                else:
-                    continue
+                    update_class, tasks_name, get_chat_id = self._dispatchers[update_type]
+                    update = update_class(item[update_type])
+                    chat_id = get_chat_id(update)
+                    if update_type == 'message':
+                        for action, action_kw in self._command_actions(update):
+                            self._submit(chat_id, action, update, action_kw)
+                    for criteria, action, action_kw in getattr(self, tasks_name):
+                        if criteria(update):
+                            self._submit(chat_id, action, update, action_kw)
+        finally:
+            poller.shutdown(wait=False)
 
         self.save_config_and_record()
 
+    def _submit(self, chat_id: int, action: Callable, obj: Any, action_kw: dict):
+        """
+        Run action in the worker pool. If ordered_chats is enabled in config, actions of the same chat are executed one
+        after another in the order they are submitted, while actions of different chats run concurrently.
+        """
+        if not self._ordered_chats:
+            self.executor.submit(self._run_action, action, obj, action_kw)
+            return
+        with self._chat_queues_lock:
+            if chat_id in self._chat_queues:
+                self._chat_queues[chat_id].append((action, obj, action_kw))
+                return
+            self._chat_queues[chat_id] = deque()
+        self.executor.submit(self._run_chat_actions, chat_id, action, obj, action_kw)
+
+    @staticmethod
+    def _run_action(action: Callable, obj: Any, action_kw: dict):
+        try:
+            action(obj, **action_kw)
+        except Exception:
+            logging.exception(f'Action {action!r} failed.')
+
+    def _run_chat_actions(self, chat_id: int, action: Callable, obj: Any, action_kw: dict):
+        while True:
+            self._run_action(action, obj, action_kw)
+            with self._chat_queues_lock:
+                queue = self._chat_queues[chat_id]
+                if not queue:
+                    del self._chat_queues[chat_id]
+                    return
+                action, obj, action_kw = queue.popleft()
+
     def send_message(self, chat_id, text: str, **kw) -> "Message":
         """
         :param chat_id: Unique identifier for the target chat or username of the target channel
@@ -306,21 +679,35 @@ class Bot(User):
             kw['reply_markup'] = kw['reply_markup'].parse()
 
         if len(text) > 4000 and 'parse_mode' not in kw:
-            text_part = [text[i * 4000: (i + 1) * 4000] for i in range(len(text) // 4000 + 1)]
+            part_suffix = f'\n\n({{}} / {(len(text) + 3999) // 4000})'.format
             sent_msg = None
-            for i in range(len(text_part)):
+            for i, start in enumerate(range(0, len(text), 4000), 1):
                 msg_payload = {
                     'chat_id': chat_id,
-                    'text': text_part[i] + f'\n\n({i + 1} / {len(text_part)})',
+                    'text': text[start:start + 4000] + part_suffix(i),
                     **kw
                 }
+                self._wait_send_slot(chat_id)
                 sent_msg = Message(self.api('sendMessage', msg_payload))
-                time.sleep(0.5)
+                # Only the first part replies to the original message
+                kw.pop('reply_to_message_id', None)
         else:
             msg_payload = {'chat_id': chat_id, 'text': text, **kw}
             sent_msg = Message(self.api('sendMessage', msg_payload))
         return sent_msg
 
+    def _wait_send_slot(self, chat_id, interval: float = 0.5):
+        """
+        Block until the chat may receive the next part of a split message, so that parts sent to one chat are at
+        least interval seconds apart. Sending to other chats is not delayed.
+        """
+        with self._send_slots_lock:
+            now = time.monotonic()
+            slot = max(now, self._send_slots.get(chat_id, 0))
+            self._send_slots[chat_id] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
     def edit_message(self, chat_id, msg_id, **kw) -> "Message":
         if 'reply_markup' in kw:
             kw['reply_markup'] = kw['reply_markup'].parse()
@@ -465,16 +852,7 @@ class Bot(User):
             chat_id=chat_id,
             user_id=user_id,
             until=until,
-            can_send_messages=False,
-            can_send_audios=False,
-            can_send_documents=False,
-            can_send_photos=False,
-            can_send_videos=False,
-            can_send_video_notes=False,
-            can_send_voice_notes=False,
-            can_send_polls=False,
-            can_send_other_messages=False,
-            can_add_web_page_previews=False
+            **_SILENCED_PERMISSIONS
         )
 
     def lift_restrictions(self, chat_id, user_id) -> bool:
@@ -488,16 +866,7 @@ class Bot(User):
             chat_id=chat_id,
             user_id=user_id,
             until=int(time.time()) + 35,
-            can_send_messages=True,
-            can_send_audios=True,
-            can_send_documents=True,
-            can_send_photos=True,
-            can_send_videos=True,
-            can_send_video_notes=True,
-            can_send_voice_notes=True,
-            can_send_polls=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True
+            **_LIFTED_PERMISSIONS
         )
 
     def kick_chat_member(self, chat_id, user_id, until: int = 0, no_ban: bool = False) -> bool:
@@ -575,19 +944,19 @@ class Bot(User):
         :param path: optional, where downloaded content is saved
         :return: if path is not given, return byte buffer
         """
-        if file.file_path:
-            res = requests.get(f'https://api.telegram.org/file/bot{self.token}/{file.file_path}')
-            if res.status_code == 200:
-                content = res.content
-            else:
-                raise FilePathError(f'File path {file.file_path} error or expired.')
-        else:
+        if not file.file_path:
             raise FilePathError('File path not found.')
-        if path:
-            with open(path, 'wb') as f:
-                f.write(content)
-        else:
-            return content
+        with self.session.get(f'https://api.telegram.org/file/bot{self.token}/{file.file_path}',
+                              proxies=self.proxies, stream=True) as res:
+            if res.status_code != 200:
+                raise FilePathError(f'File path {file.file_path} error or expired.')
+            if path:
+                # Write chunk by chunk instead of holding the whole file in memory
+                res.raw.decode_content = True
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(res.raw, f, length=64 * 1024)
+            else:
+                return res.content
 
     """
     Methods below are bot-related utility methods which are not abstractions of Telegram apis.
@@ -602,12 +971,9 @@ class Bot(User):
                      False if all commands are considered
         :return: if one of two types of command is detected
         """
-        if cmd in msg.commands and not require_username:
-            return msg.text.startswith(cmd)
-        elif f'{cmd}@{self.username}' in msg.commands:
-            return msg.text.startswith(f'{cmd}@{self.username}')
-        else:
-            return False
+        if require_username:
+            return msg._leading_command == cmd + self._at_username
+        return msg._leading_command == cmd or msg._leading_command == cmd + self._at_username
 
     def lift_and_preserve_restriction(self, chat_id, user_id, restricted_until: int) -> None:
         """
@@ -635,6 +1001,9 @@ class Bot(User):
     def secure_record_fetch(self, key: str, data_type: type, file: str = None) -> tuple[Any, dict[str, Any]]:
         """
         Securely read a record json file. Create file or json objects if needed.
+        The deserialized file is cached until the file is modified. Each call gets its own copy of the data asked for
+        and of the top level of the record, so they can be modified without affecting other callers. Other data in the
+        returned record is shared and should not be modified in place.
         :param file: file path
         :param key: Name of the data you want in record file
         :param data_type: Type of the data. For example, if it is trusted user list, data_type will be list.
@@ -642,22 +1011,52 @@ class Bot(User):
         """
         if file is None:
             file = self.config['record']
-        try:
-            rec = json.load(open(file, 'r', encoding='utf-8'))
-        except FileNotFoundError:
-            record_list, rec = data_type(), {}
-            json.dump({key: record_list}, open(self.config['record'], 'w', encoding='utf-8'), indent=2,
-                      ensure_ascii=False)
-        else:
-            if key in rec:
-                record_list = rec[key]
-            else:
+        # The cache is shared by actions running in different threads
+        with self._record_lock:
+            try:
+                stat = os.stat(file)
+                cached = self._record_cache.get(file)
+                if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+                    cached_rec = cached[1]
+                else:
+                    cached_rec, _ = _load_json_file(file)
+                    self._record_cache[file] = ((stat.st_mtime_ns, stat.st_size), cached_rec)
+            except FileNotFoundError:
                 record_list = data_type()
+                _write_atomic(file, _json_dumps({key: record_list}))
+                return record_list, {}
+
+        # The cached record is never modified. Copying the data through json is cheaper than copy.deepcopy.
+        rec = dict(cached_rec)
+        if key in rec:
+            record_list = rec[key] = _json_loads(_json_dumps(rec[key], indent=False))
+        else:
+            record_list = data_type()
 
         return record_list, rec
 
 
 class ChatMember(User):
+    __slots__ = (
+        'chat_id', 'status', 'is_anonymous', 'can_be_edited', 'can_delete_messages', 'can_promote_members',
+        'can_post_messages', 'can_edit_messages', 'can_pin_messages', 'can_change_info', 'can_invite_users',
+        'custom_title', 'until_date', 'is_member', 'can_send_messages', 'can_send_audios', 'can_send_documents',
+        'can_send_photos', 'can_send_videos', 'can_send_video_notes', 'can_send_voice_notes', 'can_send_polls',
+        'can_send_other_messages', 'can_add_web_page_previews'
+    )
+    _ADMIN_PRIVILEGES = (
+        'is_anonymous', 'can_be_edited', 'can_delete_messages', 'can_promote_members', 'can_post_messages',
+        'can_edit_messages', 'can_pin_messages', 'can_change_info', 'can_invite_users'
+    )
+    # Privileges in the response only if the member is an administrator
+    _ADMIN_ONLY_PRIVILEGES = ('can_be_edited', 'can_delete_messages', 'can_promote_members')
+    # can_send_other_messages: sticker, gif and inline bot. can_add_web_page_previews: "embed links" in client
+    _RESTRICTABLE_PERMISSIONS = (
+        'can_send_messages', 'can_send_audios', 'can_send_documents', 'can_send_photos', 'can_send_videos',
+        'can_send_video_notes', 'can_send_voice_notes', 'can_send_polls', 'can_send_other_messages',
+        'can_add_web_page_previews', 'can_pin_messages'
+    )
+
     def __init__(self, member_json: dict, chat_id):
         """
         Typically, build a ChatMember object from Bot.get_chat_member() method, which automatically get corresponding
@@ -666,21 +1065,14 @@ class ChatMember(User):
         :param chat_id: ID of the chat which this ChatMember belongs to.
         """
         super().__init__(member_json['user'])
-        self.raw = f'{{"chat_member": {member_json}, "chat_id": {chat_id}}}'
+        self.raw = {'chat_member': member_json, 'chat_id': chat_id}
         self.chat_id: int = chat_id
         # Can be “creator”, “administrator”, “member”, “restricted”, “left” or “kicked”
         self.status: str = member_json['status']
 
         # Admin privileges are False for non-admins
-        self.is_anonymous = False
-        self.can_be_edited = False
-        self.can_delete_messages = False
-        self.can_promote_members = False
-        self.can_post_messages = False
-        self.can_edit_messages = False
-        self.can_pin_messages = False
-        self.can_change_info = False
-        self.can_invite_users = False
+        for field in self._ADMIN_PRIVILEGES:
+            setattr(self, field, False)
         self.custom_title: Optional[str] = None
 
         if self.status == 'administrator' or self.status == 'creator':
@@ -688,9 +1080,8 @@ class ChatMember(User):
             if 'custom_title' in member_json:
                 self.custom_title: Optional[str] = member_json['custom_title']
         if self.status == 'administrator':
-            self.can_be_edited: bool = member_json['can_be_edited']
-            self.can_delete_messages: bool = member_json['can_delete_messages']
-            self.can_promote_members: bool = member_json['can_promote_members']
+            for field in self._ADMIN_ONLY_PRIVILEGES:
+                setattr(self, field, member_json[field])
             # If it is a channel
             if 'can_post_messages' in member_json:
                 self.can_post_messages = member_json['can_post_messages']
@@ -705,259 +1096,230 @@ class ChatMember(User):
         # Restricted actions are allowed for non-restricted users
         self.until_date: Optional[int] = None
         self.is_member = True
-        self.can_send_messages = True
-        self.can_send_audios = True
-        self.can_send_documents = True
-        self.can_send_photos = True
-        self.can_send_videos = True
-        self.can_send_video_notes = True
-        self.can_send_voice_notes = True
-        self.can_send_polls = True
-        self.can_send_other_messages = True
-        self.can_add_web_page_previews = True
-        self.can_pin_messages = True
-
         if self.status == 'restricted':
             self.until_date: Optional[int] = member_json['until_date']
             self.is_member: bool = member_json['is_member']
-            self.can_send_messages: bool = member_json['can_send_messages']
-            self.can_send_audios: bool = member_json['can_send_audios']
-            self.can_send_documents: bool = member_json['can_send_documents']
-            self.can_send_photos: bool = member_json['can_send_photos']
-            self.can_send_videos: bool = member_json['can_send_videos']
-            self.can_send_video_notes: bool = member_json['can_send_video_notes']
-            self.can_send_voice_notes: bool = member_json['can_send_voice_notes']
-            self.can_send_polls: bool = member_json['can_send_polls']
-            self.can_send_other_messages: bool = member_json['can_send_other_messages']  # sticker, gif and inline bot
-            self.can_add_web_page_previews: bool = member_json['can_add_web_page_previews']  # "embed links" in client
-            self.can_pin_messages: bool = member_json['can_pin_messages']
+            for field in self._RESTRICTABLE_PERMISSIONS:
+                setattr(self, field, member_json[field])
+        else:
+            for field in self._RESTRICTABLE_PERMISSIONS:
+                setattr(self, field, True)
         if self.status == 'kicked':
             self.until_date: int = member_json['until_date']
 
     def __str__(self):
-        return self.raw
+        return _json_dumps(self.raw, indent=False).decode('utf-8')
 
 
 class Message:
+    __slots__ = (
+        'raw', 'id', 'from_', 'date', 'author_signature', 'forward', 'forward_sender_name', 'forward_from_message_id',
+        'forward_signature', 'forward_date', 'reply', 'edit_date', 'edit', 'text', 'has_photo', 'dice', 'dice_emoji',
+        'dice_value',
+        # Caches of lazily built fields
+        '_cached_chat', '_cached_link', '_cached_sender_chat', '_cached_forward_from', '_cached_forward_from_chat',
+        '_cached_reply_to_message', '_cached_photo',
+        '_cached_new_chat_members', '_cached_left_chat_member', '_cached_reply_markup', '_cached__entities',
+        '_cached_html_formatted_text'
+    )
+
     def __init__(self, msg_json: dict):
+        """
+        Fields that are expensive to build and seldom used by handlers (chats, forward origins, replied message,
+        photos, members, reply markup and entities) are built from msg_json when they are first accessed.
+        """
         self.raw = msg_json
-        self.chat = Chat(msg_json['chat'])
         self.id: int = msg_json['message_id']
 
         # Empty for message in channels
-        if 'from' in msg_json:
-            self.from_: Optional[User] = User(msg_json['from'])
-        else:
-            self.from_: Optional[User] = None
+        from_json = msg_json.get('from')
+        self.from_: Optional[User] = User(from_json) if from_json is not None else None
 
-        if str(self.chat.id).startswith('-100'):
-            self.link: str = f't.me/c/{str(self.chat.id).replace("-100", "")}/{self.id}'
-        else:
-            self.link: str = ''
-
-        # The channel itself for channel messages. The supergroup itself for messages from anonymous group 
-        # administrators. The linked channel for messages automatically forwarded to the discussion group
-        if 'sender_chat' in msg_json:
-            self.sender_chat: Optional[Chat] = Chat(msg_json['sender_chat'])
-        else:
-            self.sender_chat: Optional[Chat] = None
         self.date: int = msg_json['date']
 
         # Signature of the post author for messages in channels, or the custom title of an anonymous group administrator
-        if 'author_signature' in msg_json:
-            self.author_signature: Optional[str] = msg_json['author_signature']
-        else:
-            self.author_signature: Optional[str] = None
+        self.author_signature: Optional[str] = msg_json.get('author_signature')
 
-        if 'forward_from' in msg_json:
-            # forwarded from users who allowed a link to their account in forwarded message
-            self.forward_from: Optional[User] = User(msg_json['forward_from'])
-            self.forward = True
-        else:
-            self.forward_from: Optional[User] = None
-            self.forward = False
-        if 'forward_sender_name' in msg_json:
-            # forwarded from users who disallowed a link to their account in forwarded message
-            self.forward_sender_name: Optional[str] = msg_json['forward_sender_name']
-            self.forward = True
-        else:
-            self.forward_sender_name: Optional[str] = None
-            self.forward = False
-        if 'forward_from_message_id' in msg_json:
-            # forwarded from channels
-            self.forward_from_chat: Optional[Chat] = Chat(msg_json['forward_from_chat'])
-            self.forward_from_message_id: Optional[int] = msg_json['forward_from_message_id']
-            if 'forward_signature' in msg_json:
-                self.forward_signature: Optional[str] = msg_json['forward_signature']
-            else:
-                self.forward_signature: Optional[str] = None
-            self.forward = True
-        else:
-            self.forward_from_chat: Optional[Chat] = None
-            self.forward_from_message_id: Optional[int] = None
-            self.forward = False
-        if 'forward_from_chat' in msg_json:
-            # forwarded from anonymous admins
-            self.forward_from_chat: Optional[Chat] = Chat(msg_json['forward_from_chat'])
-            self.forward = True
-        else:
-            self.forward_from_chat: Optional[Chat] = None
-            self.forward = False
+        # forwarded from users who disallowed a link to their account in forwarded message
+        self.forward_sender_name: Optional[str] = msg_json.get('forward_sender_name')
+        self.forward_from_message_id: Optional[int] = msg_json.get('forward_from_message_id')
+        self.forward_signature: Optional[str] = msg_json.get('forward_signature')
+        self.forward = any(key in msg_json for key in _FORWARD_KEYS)
+        self.forward_date: Optional[int] = msg_json['forward_date'] if self.forward else None
 
-        if self.forward:
-            self.forward_date: Optional[int] = msg_json['forward_date']
-        else:
-            self.forward_date: Optional[int] = None
+        self.reply = 'reply_to_message' in msg_json
 
-        if 'reply_to_message' in msg_json:
-            self.reply_to_message: Optional[Message] = Message(msg_json['reply_to_message'])
-            self.reply = True
-        else:
-            self.reply_to_message: Optional[Message] = None
-            self.reply = False
+        self.edit_date: Optional[int] = msg_json.get('edit_date')
+        self.edit = self.edit_date is not None
 
-        if 'edit_date' in msg_json:
-            self.edit_date: Optional[int] = msg_json['edit_date']
-            self.edit = True
-        else:
-            self.edit_date: Optional[int] = None
-            self.edit = False
+        self.text: str = msg_json.get('text')
+        if self.text is None:
+            self.text = msg_json.get('caption', '')
 
-        if 'text' in msg_json:
-            self.text: str = msg_json['text']
-        elif 'caption' in msg_json:
-            self.text: str = msg_json['caption']
-        else:
-            self.text: str = ''
+        self.has_photo = 'photo' in msg_json
 
-        if 'photo' in msg_json:
-            self.photo: Optional[list[PhotoSize]] = []
-            self.has_photo = True
-            for photo in msg_json['photo']:
-                self.photo.append(PhotoSize(photo))
-        else:
-            self.photo: Optional[list[PhotoSize]] = None
-            self.has_photo = False
+        dice = msg_json.get('dice')
+        self.dice = dice is not None
+        self.dice_emoji: Optional[str] = dice['emoji'] if self.dice else None
+        self.dice_value: Optional[int] = dice['value'] if self.dice else None
 
-        if 'new_chat_members' in msg_json:
-            self.new_chat_members: Optional[list[User]] = []
-            for user_json in msg_json['new_chat_members']:
-                self.new_chat_members.append(User(user_json))
-        else:
-            self.new_chat_members: Optional[list[User]] = None
+    @_cached_slot
+    def chat(self) -> "Chat":
+        return Chat(self.raw['chat'])
 
-        if 'left_chat_member' in msg_json:
-            self.left_chat_member: Optional[User] = User(msg_json['left_chat_member'])
-        else:
-            self.left_chat_member: Optional[User] = None
-
-        self.mentions = []
-        self.hashtags = []
-        self.cashtags = []
-        self.commands = []
-        self.links = []
-        self.bolds = []
-        self.italics = []
-        self.underlines = []
-        self.strikethroughs = []
-        self.spoilers = []
-        self.codes = []
-        self.text_links = []
-        self.text_mention = []
-        self.html_formatted_text = self.text
-        if 'entities' in msg_json or 'caption_entities' in msg_json:
-            entity_type = 'entities' if 'entities' in msg_json else 'caption_entities'
-            entity_to_be_formatted = []
-            for item in msg_json[entity_type]:
-                offset = item['offset']
-                length = item['length']
-                if item['type'] == 'mention':
-                    self.mentions.append(self.text[offset:offset + length])
-                elif item['type'] == 'hashtag':
-                    self.hashtags.append(self.text[offset:offset + length])
-                elif item['type'] == 'cashtag':
-                    self.cashtags.append(self.text[offset:offset + length])
-                elif item['type'] == 'bot_command':
-                    self.commands.append(self.text[offset:offset + length])
-                elif item['type'] == 'url':
-                    self.links.append(self.text[offset:offset + length])
-                elif item['type'] == 'bold':
-                    self.bolds.append(self.text[offset:offset + length])
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'italic':
-                    self.italics.append(self.text[offset:offset + length])
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'underline':
-                    self.underlines.append(self.text[offset:offset + length])
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'strikethrough':
-                    self.strikethroughs.append(self.text[offset:offset + length])
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'spoiler':
-                    self.spoilers.append(self.text[offset:offset + length])
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'code':
-                    self.codes.append(self.text[offset:offset + length])
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'text_link':
-                    self.text_links.append((self.text[offset:offset + length], item['url']))
-                    entity_to_be_formatted.append(item)
-                elif item['type'] == 'text_mention':
-                    self.text_mention.append((self.text[offset:offset + length], User(item['user'])))
-                    entity_to_be_formatted.append(item)
-
-            entity_to_be_formatted = sorted(entity_to_be_formatted, key=lambda x: x['offset'], reverse=True)
-            for item in entity_to_be_formatted:
-                offset = item['offset']
-                length = item['length']
-                if item['type'] == 'bold':
-                    self.html_formatted_text = self.text[:offset] + f'<b>{self.text[offset:offset + length]}</b>' + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'italic':
-                    self.html_formatted_text = self.text[:offset] + f'<i>{self.text[offset:offset + length]}</i>' + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'underline':
-                    self.html_formatted_text = self.text[:offset] + f'<u>{self.text[offset:offset + length]}</u>' + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'strikethrough':
-                    self.html_formatted_text = self.text[:offset] + f'<s>{self.text[offset:offset + length]}</s>' + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'spoiler':
-                    self.html_formatted_text = self.text[:offset] + \
-                                               f'<tg-spoiler>{self.text[offset:offset + length]}</tg-spoiler>' + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'code':
-                    self.html_formatted_text = self.text[:offset] + \
-                                               f'<code>{self.text[offset:offset + length]}</code>' + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'text_link':
-                    self.html_formatted_text = self.text[:offset] + f"<a href=\"{item['url']}\">" \
-                                                                    f"{self.text[offset:offset + length]}</a>" + \
-                                               self.html_formatted_text[offset + length:]
-                elif item['type'] == 'text_mention':
-                    self.html_formatted_text = self.text[:offset] + f"<a href=\"tg://user?id={item['user']['id']}\">" \
-                                                                    f"{self.text[offset:offset + length]}</a>" + \
-                                               self.html_formatted_text[offset + length:]
-
-        if 'dice' in msg_json:
-            self.dice = True
-            self.dice_emoji: Optional[str] = msg_json['dice']['emoji']
-            self.dice_value: Optional[int] = msg_json['dice']['value']
+    @_cached_slot
+    def link(self) -> str:
+        chat_id = str(self.chat.id)
+        if chat_id.startswith('-100'):
+            return f't.me/c/{chat_id[4:]}/{self.id}'
         else:
-            self.dice = False
-            self.dice_emoji: Optional[str] = None
-            self.dice_value: Optional[str] = None
+            return ''
 
-        if 'reply_markup' in msg_json:
-            self.reply_markup: Optional[InlineKeyboard] = InlineKeyboard.from_json(msg_json['reply_markup'])
+    @_cached_slot
+    def sender_chat(self) -> Optional["Chat"]:
+        # The channel itself for channel messages. The supergroup itself for messages from anonymous group
+        # administrators. The linked channel for messages automatically forwarded to the discussion group
+        if 'sender_chat' in self.raw:
+            return Chat(self.raw['sender_chat'])
+        return None
+
+    @_cached_slot
+    def forward_from(self) -> Optional[User]:
+        # Forwarded from users who allowed a link to their account in forwarded message
+        if 'forward_from' in self.raw:
+            return User(self.raw['forward_from'])
+        return None
+
+    @_cached_slot
+    def forward_from_chat(self) -> Optional["Chat"]:
+        # Forwarded from channels (with forward_from_message_id) or anonymous admins (without it)
+        if 'forward_from_chat' in self.raw:
+            return Chat(self.raw['forward_from_chat'])
+        return None
+
+    @_cached_slot
+    def reply_to_message(self) -> Optional["Message"]:
+        if self.reply:
+            return Message(self.raw['reply_to_message'])
+        return None
+
+    @_cached_slot
+    def photo(self) -> Optional[list["PhotoSize"]]:
+        if self.has_photo:
+            return [PhotoSize(photo) for photo in self.raw['photo']]
+        return None
+
+    @_cached_slot
+    def new_chat_members(self) -> Optional[list[User]]:
+        if 'new_chat_members' in self.raw:
+            return [User(user_json) for user_json in self.raw['new_chat_members']]
+        return None
+
+    @_cached_slot
+    def left_chat_member(self) -> Optional[User]:
+        if 'left_chat_member' in self.raw:
+            return User(self.raw['left_chat_member'])
+        return None
+
+    @_cached_slot
+    def reply_markup(self) -> Optional["InlineKeyboard"]:
+        if 'reply_markup' in self.raw:
+            return InlineKeyboard.from_json(self.raw['reply_markup'])
+        return None
+
+    @_cached_slot
+    def _entities(self) -> dict[str, Any]:
+        """
+        Collect entities of all types in one pass. Entity lists of the message are read from here. Messages without
+        entities share _NO_ENTITIES, whose entity lists are empty tuples.
+        """
+        msg_json = self.raw
+        if 'entities' in msg_json:
+            entity_type = 'entities'
+        elif 'caption_entities' in msg_json:
+            entity_type = 'caption_entities'
         else:
-            self.reply_markup: Optional[InlineKeyboard] = None
+            return _NO_ENTITIES
+        entities = {name: [] for name in _ENTITY_LISTS.values()}
+        # The command that the text starts with, e.g. "/start" or "/start@somebot". Empty if there is none.
+        entities['leading_command'] = ''
+        entity_to_be_formatted = entities['formatted'] = []
+        # Local name instead of attribute lookups in the loop below
+        text = self.text
+        for item in msg_json[entity_type]:
+            item_type = item['type']
+            list_name = _ENTITY_LISTS.get(item_type)
+            if list_name is None:
+                continue
+            offset = item['offset']
+            fragment = text[offset:offset + item['length']]
+            if item_type == 'text_link':
+                content = (fragment, item['url'])
+            elif item_type == 'text_mention':
+                content = (fragment, User(item['user']))
+            else:
+                content = fragment
+                if item_type == 'bot_command' and offset == 0:
+                    entities['leading_command'] = fragment
+            entities[list_name].append(content)
+            if item_type in _FORMATTED_ENTITIES:
+                # The fragment is kept so that html_formatted_text does not slice the text again
+                entity_to_be_formatted.append((offset, fragment, item))
+        # Sorted once here, so that html_formatted_text can consume them in order
+        entity_to_be_formatted.sort(key=itemgetter(0))
+        return entities
+
+    mentions: list[str] = _entity_list('mentions')
+    hashtags: list[str] = _entity_list('hashtags')
+    cashtags: list[str] = _entity_list('cashtags')
+    commands: list[str] = _entity_list('commands')
+    links: list[str] = _entity_list('links')
+    bolds: list[str] = _entity_list('bolds')
+    italics: list[str] = _entity_list('italics')
+    underlines: list[str] = _entity_list('underlines')
+    strikethroughs: list[str] = _entity_list('strikethroughs')
+    spoilers: list[str] = _entity_list('spoilers')
+    codes: list[str] = _entity_list('codes')
+    text_links: list[tuple[str, str]] = _entity_list('text_links')
+    text_mention: list[tuple[str, User]] = _entity_list('text_mention')
+
+    @property
+    def _leading_command(self) -> str:
+        return self._entities['leading_command']
+
+    @_cached_slot
+    def html_formatted_text(self) -> str:
+        text = self.text
+        entity_to_be_formatted = self._entities['formatted']
+        if not entity_to_be_formatted:
+            return text
+        html_parts = []
+        cursor = 0
+        for offset, fragment, item in entity_to_be_formatted:
+            if offset < cursor:
+                # Nested in the previous entity
+                continue
+            if item['type'] == 'text_link':
+                open_tag, close_tag = f"<a href=\"{item['url']}\">", '</a>'
+            elif item['type'] == 'text_mention':
+                open_tag, close_tag = f"<a href=\"tg://user?id={item['user']['id']}\">", '</a>'
+            else:
+                open_tag, close_tag = _HTML_TAGS[item['type']]
+            html_parts.append(text[cursor:offset])
+            html_parts.append(open_tag)
+            html_parts.append(fragment)
+            html_parts.append(close_tag)
+            cursor = offset + item['length']
+        html_parts.append(text[cursor:])
+        return ''.join(html_parts)
 
     def __str__(self):
-        return self.raw
+        return _json_dumps(self.raw, indent=False).decode('utf-8')
 
 
 class InlineKeyboardButton:
+    __slots__ = ('text', 'url', 'callback_data')
+
     def __init__(self, text: str, **kwargs):
         """
         :param text: Text showed on the button.
@@ -967,16 +1329,10 @@ class InlineKeyboardButton:
             - callback_data: Optional. Data to be sent in a callback query to the bot when button is pressed, 1-64 bytes
         """
         self.text = text
-        if len(kwargs) == 0:
+        if not kwargs:
             raise APIError('Inline keyboard button must have either url or callback_data.')
-        if 'url' in kwargs:
-            self.url: str = kwargs['url']
-        else:
-            self.url = ''
-        if 'callback_data' in kwargs:
-            self.callback_data: str = kwargs['callback_data']
-        else:
-            self.callback_data: str = ''
+        self.url: str = kwargs.get('url', '')
+        self.callback_data: str = kwargs.get('callback_data', '')
 
     @classmethod
     def from_json(cls, button_json: dict):
@@ -984,12 +1340,14 @@ class InlineKeyboardButton:
 
     def parse(self) -> dict:
         """
-        :return: self.__dict__ for follow-up usage like json serialization.
+        :return: a dict of the button for follow-up usage like json serialization.
         """
-        return self.__dict__
+        return {'text': self.text, 'url': self.url, 'callback_data': self.callback_data}
 
 
 class InlineKeyboard:
+    __slots__ = ('key_list',)
+
     def __init__(self, key_list: list[list[InlineKeyboardButton]]):
         """
         :param key_list: Use InlineKeyBoardButton to structure the buttons you want and pass it into this
@@ -1000,26 +1358,17 @@ class InlineKeyboard:
 
     @classmethod
     def from_json(cls, markup_json: dict) -> "InlineKeyboard":
-        markup_list: list[list[dict]] = markup_json['inline_keyboard']
-        key_list: list[list[InlineKeyboardButton]] = []
-        for i in range(len(markup_json)):
-            key_list.append([])
-            for j in range(len(markup_json)):
-                key_list[i].append(InlineKeyboardButton.from_json(markup_list[i][j]))
-
-        return cls(key_list)
+        return cls([
+            [InlineKeyboardButton.from_json(button) for button in row] for row in markup_json['inline_keyboard']
+        ])
 
     def parse(self) -> dict[str, list[list[dict]]]:
-        key_list: list[list[dict]] = []
-        for i in range(len(self.key_list)):
-            key_list.append([])
-            for j in range(len(self.key_list[i])):
-                key_list[i].append(self.key_list[i][j].parse())
-
-        return {'inline_keyboard': key_list}
+        return {'inline_keyboard': [[button.parse() for button in row] for row in self.key_list]}
 
 
 class CallbackQuery:
+    __slots__ = ('raw', 'id', 'from_', 'msg', 'chat_instance', 'data', 'inline_message_id')
+
     def __init__(self, query_json: dict):
         self.raw = query_json
         self.id: str = query_json['id']
@@ -1027,26 +1376,20 @@ class CallbackQuery:
 
         # Message with the callback button that originated the query.
         # Note that message content and message date will not be available if the message is too old
-        if 'message' in query_json:
-            self.msg: Optional[Message] = Message(query_json['message'])
-        else:
-            self.msg: Optional[Message] = None
+        msg_json = query_json.get('message')
+        self.msg: Optional[Message] = Message(msg_json) if msg_json is not None else None
         self.chat_instance: str = query_json['chat_instance']
 
-        if 'data' in query_json:
-            self.data: str = query_json['data']
-        else:
-            self.data = ''
-        if 'inline_message_id' in query_json:
-            self.inline_message_id: str = query_json['inline_message_id']
-        else:
-            self.inline_message_id = ''
+        self.data: str = query_json.get('data', '')
+        self.inline_message_id: str = query_json.get('inline_message_id', '')
 
     def __str__(self):
-        return self.raw
+        return _json_dumps(self.raw, indent=False).decode('utf-8')
 
 
 class ChatMemberUpdate:
+    __slots__ = ('raw', 'chat', 'from_', 'date', 'old_chat_member', 'new_chat_member')
+
     def __init__(self, update_json: dict):
         self.raw = update_json
         self.chat = Chat(update_json['chat'])
@@ -1060,26 +1403,28 @@ class ChatMemberUpdate:
 
 
 class ChatJoinRequestUpdate:
+    __slots__ = ('raw', 'chat', 'from_', 'user_chat_id', 'date', 'bio', 'invite_link')
+
     def __init__(self, update_json: dict):
         self.raw = update_json
         self.chat = Chat(update_json['chat'])
         self.from_ = User(update_json['from'])
         self.user_chat_id: int = update_json['user_chat_id']
         self.date: int = update_json['date']
-        if 'bio' in update_json:
-            self.bio: Optional[str] = update_json['bio']
-        else:
-            self.bio: Optional[str] = None
-        if 'invite_link' in update_json:
-            self.invite_link: Optional[ChatInviteLink] = ChatInviteLink(update_json['invite_link'])
-        else:
-            self.invite_link: Optional[ChatInviteLink] = None
+        self.bio: Optional[str] = update_json.get('bio')
+        invite_link = update_json.get('invite_link')
+        self.invite_link: Optional[ChatInviteLink] = ChatInviteLink(invite_link) if invite_link is not None else None
 
     def __str__(self):
         return str(self.raw)
 
 
 class ChatInviteLink:
+    __slots__ = (
+        'raw', 'invite_link', 'creator', 'creates_join_request', 'is_primary', 'is_revoked', 'name', 'expire_date',
+        'member_limit', 'pending_join_request_count'
+    )
+
     def __init__(self, link_json: dict):
         self.raw = link_json
         self.invite_link = link_json['invite_link']
@@ -1087,28 +1432,21 @@ class ChatInviteLink:
         self.creates_join_request: bool = link_json['creates_join_request']
         self.is_primary: bool = link_json['is_primary']
         self.is_revoked: bool = link_json['is_revoked']
-        if 'name' in link_json:
-            self.name: Optional[str] = link_json['name']
-        else:
-            self.name: Optional[int] = None
-        if 'expire_date' in link_json:
-            self.expire_date: Optional[int] = link_json['expire_date']
-        else:
-            self.expire_date: Optional[int] = None
-        if 'member_limit' in link_json:
-            self.member_limit: Optional[int] = link_json['member_limit']
-        else:
-            self.member_limit: Optional[int] = None
-        if 'pending_join_request_count' in link_json:
-            self.pending_join_request_count: Optional[int] = link_json['pending_join_request_count']
-        else:
-            self.pending_join_request_count: Optional[int] = None
+        self.name: Optional[str] = link_json.get('name')
+        self.expire_date: Optional[int] = link_json.get('expire_date')
+        self.member_limit: Optional[int] = link_json.get('member_limit')
+        self.pending_join_request_count: Optional[int] = link_json.get('pending_join_request_count')
 
     def __str__(self):
         return str(self.raw)
 
 
 class Chat:
+    __slots__ = (
+        'raw', 'id', 'type', 'name', 'username', 'link', 'bio', 'description', 'pinned_message', 'slow_mode_delay',
+        'join_by_request', 'linked_chat_id', 'invite_link'
+    )
+
     def __init__(self, chat_json: dict):
         self.raw = chat_json
         self.id: int = chat_json['id']
@@ -1117,80 +1455,49 @@ class Chat:
         if self.type == 'supergroup' or self.type == 'group' or self.type == 'channel':
             self.name: str = chat_json['title']
         else:
-            if 'last_name' in chat_json:
-                self.name = f'{chat_json["first_name"]} {chat_json["last_name"]}'
-            else:
+            last_name = chat_json.get('last_name')
+            if last_name is None:
                 self.name = chat_json['first_name']
+            else:
+                self.name = f"{chat_json['first_name']} {last_name}"
 
-        if 'username' in chat_json:
-            self.username: str = chat_json['username']
-            self.link = 't.me/' + self.username
-        else:
-            self.username = ''
-            self.link = ''
+        self.username: str = chat_json.get('username', '')
+        self.link = 't.me/' + self.username if self.username else ''
 
         # Returned by get_chat
-        if 'bio' in chat_json:
-            # If the chat is private chat
-            self.bio: Optional[str] = chat_json['bio']
-        else:
-            self.bio: Optional[str] = None
-        if 'description' in chat_json:
-            # If the chat is group, supergroup or channel
-            self.description: Optional[str] = chat_json['description']
-        else:
-            self.description: Optional[str] = None
-        if 'pinned_message' in chat_json:
-            self.pinned_message: Optional[Message] = Message(chat_json['pinned_message'])
-        else:
-            self.pinned_message: Optional[Message] = None
-        if 'slow_mode_delay' in chat_json:
-            # If the chat is supergroup
-            self.slow_mode_delay: int = chat_json['slow_mode_delay']
-        else:
-            self.slow_mode_delay = 0
-        if 'join_by_request' in chat_json:
-            self.join_by_request: bool = chat_json['join_by_request']
-        else:
-            self.join_by_request = False
-        if 'linked_chat_id' in chat_json:
-            # If the supergroup or channel has a linked channel or supergroup, respectively
-            self.linked_chat_id: Optional[int] = chat_json['linked_chat_id']
-        else:
-            self.linked_chat_id: Optional[int] = None
-        if 'invite_link' in chat_json:
-            self.invite_link: Optional[str] = chat_json['invite_link']
-        else:
-            self.invite_link: Optional[str] = None
+        self.bio: Optional[str] = chat_json.get('bio')  # If the chat is private chat
+        self.description: Optional[str] = chat_json.get('description')  # If the chat is group, supergroup or channel
+        pinned_message = chat_json.get('pinned_message')
+        self.pinned_message: Optional[Message] = Message(pinned_message) if pinned_message is not None else None
+        self.slow_mode_delay: int = chat_json.get('slow_mode_delay', 0)  # If the chat is supergroup
+        self.join_by_request: bool = chat_json.get('join_by_request', False)
+        # If the supergroup or channel has a linked channel or supergroup, respectively
+        self.linked_chat_id: Optional[int] = chat_json.get('linked_chat_id')
+        self.invite_link: Optional[str] = chat_json.get('invite_link')
 
     def __str__(self):
         return str(self.raw)
 
 
 class File:
+    __slots__ = ('file_id', 'file_unique_id', 'file_size', 'file_path')
+
     def __init__(self, file_json: dict):
         self.file_id: str = file_json['file_id']
         self.file_unique_id: str = file_json['file_unique_id']
-        if 'file_size' in file_json:
-            self.file_size: int = file_json['file_size']
-        else:
-            self.file_size = -1
-        if 'file_path' in file_json:
-            self.file_path: str = file_json['file_path']
-        else:
-            self.file_path = ''
+        self.file_size: int = file_json.get('file_size', -1)
+        self.file_path: str = file_json.get('file_path', '')
 
 
 class PhotoSize:
+    __slots__ = ('file_id', 'file_unique_id', 'width', 'height', 'file_size')
+
     def __init__(self, photo_json: dict):
         self.file_id: str = photo_json['file_id']
         self.file_unique_id: str = photo_json['file_unique_id']
         self.width: int = photo_json['width']
         self.height: int = photo_json['height']
-        if 'file_size' in photo_json:
-            self.file_size: int = photo_json['file_size']
-        else:
-            self.file_size = -1
+        self.file_size: int = photo_json.get('file_size', -1)
 
 
 class APIError(Exception):
@@ -1237,25 +1544,34 @@ class JoinRequestUserAlreadyParticipantError(APIError):
     pass
 
 
+# Exception classes and the error descriptions they are raised for. Earlier ones take precedence.
+_API_ERRORS: tuple[tuple[type[APIError], tuple[str, ...]], ...] = (
+    (InsufficientRightError, ('Bad Request: not enough rights to restrict/unrestrict chat member',)),
+    (UserNotFoundError, ('Bad Request: user not found',)),
+    (RestrictAdminError, (
+        'Bad Request: user is an administrator',
+        'Bad Request: can\'t remove chat owner',
+        'Bad Request: not enough rights'
+    )),
+    (DeleteMessageError, (
+        'Bad Request: message identifier is not specified',
+        'Bad Request: message can\'t be deleted',
+        'Bad Request: message to delete not found'
+    )),
+    (JoinRequestUserAlreadyParticipantError, ('Bad Request: USER_ALREADY_PARTICIPANT',)),
+    (JoinRequestNotFoundError, ('Bad Request: USER_ID_INVALID', 'Bad Request: HIDE_REQUESTER_MISSING')),
+    (ChatNotFoundError, ('Bad Request: chat not found',)),
+)
+# All descriptions start with "Bad Request: ", so every alternative matches at the same position and the first
+# alternative that matches wins, keeping the precedence of _API_ERRORS.
+_API_ERROR_PATTERN = re.compile('|'.join(
+    f'(?P<e{i}>{"|".join(re.escape(description) for description in descriptions)})'
+    for i, (_, descriptions) in enumerate(_API_ERRORS)
+))
+
+
 def api_error_transformer(e: APIError) -> APIError:
-    if 'Bad Request: not enough rights to restrict/unrestrict chat member' in e.args[0]:
-        return InsufficientRightError(e.args[0])
-    elif 'Bad Request: user not found' in e.args[0]:
-        return UserNotFoundError(e.args[0])
-    elif 'Bad Request: user is an administrator' in e.args[0] or \
-            'Bad Request: can\'t remove chat owner' in e.args[0] or \
-            'Bad Request: not enough rights' in e.args[0]:
-        return RestrictAdminError(e.args[0])
-    elif 'Bad Request: message identifier is not specified' in e.args[0] or \
-            'Bad Request: message can\'t be deleted' in e.args[0] or \
-            'Bad Request: message to delete not found' in e.args[0]:
-        return DeleteMessageError(e.args[0])
-    elif 'Bad Request: USER_ALREADY_PARTICIPANT' in e.args[0]:
-        return JoinRequestUserAlreadyParticipantError(e.args[0])
-    elif 'Bad Request: USER_ID_INVALID' in e.args[0] or \
-            'Bad Request: HIDE_REQUESTER_MISSING' in e.args[0]:
-        return JoinRequestNotFoundError(e.args[0])
-    elif 'Bad Request: chat not found' in e.args[0]:
-        return ChatNotFoundError(e.args[0])
-    else:
+    match = _API_ERROR_PATTERN.search(e.args[0])
+    if match is None:
         return e
+    return _API_ERRORS[int(match.lastgroup[1:])][0](e.args[0])
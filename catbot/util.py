@@ -1,12 +1,11 @@
-def html_escape(ori: str) -> str:
-    escape = {
-        '<': '&lt;',
-        '>': '&gt;',
-        '"': '&quot;',
-        '“': '&#8220;',
-        '”': '&#8221;'
-    }
-    for k in escape:
-        ori = ori.replace(k, escape[k])
+_ESCAPE_TABLE = str.maketrans({
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    '“': '&#8220;',
+    '”': '&#8221;'
+})
+
 
-    return ori
+def html_escape(ori: str) -> str:
+    return ori.translate(_ESCAPE_TABLE)
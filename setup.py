@@ -9,5 +9,6 @@ setup(
     author='The-Earth',
     author_email='',
     description='',
-    install_requires='requests'
+    install_requires='requests',
+    extras_require={'orjson': ['orjson']}
 )
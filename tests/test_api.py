@@ -0,0 +1,59 @@
+import json
+import threading
+
+import pytest
+import requests
+
+import catbot
+
+ME = {'id': 1, 'is_bot': True, 'first_name': 'Cat', 'username': 'catbot', 'can_join_groups': True,
+      'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+
+def fake_send(responses):
+    """
+    Make a replacement of _TelegramAdapter.send answering getMe, then returning (status, body) of responses in order.
+    """
+    def send(self, request, **kwargs):
+        resp = requests.Response()
+        resp.request = request
+        if request.url.endswith('/getMe'):
+            resp.status_code, resp._content = 200, json.dumps({'ok': True, 'result': ME}).encode()
+        else:
+            resp.status_code, resp._content = responses.pop(0)
+        return resp
+
+    return send
+
+
+def test_start_survives_non_json_response(monkeypatch):
+    stop_event = threading.Event()
+    empty = (200, json.dumps({'ok': True, 'result': []}).encode())
+    responses = [empty, (502, b'<html>502 Bad Gateway</html>'), empty]
+    monkeypatch.setattr(catbot._TelegramAdapter, 'send', fake_send(responses))
+    bot = catbot.Bot(config={'token': '1:x'})
+    original_get_updates = bot.get_updates
+
+    def get_updates(*args, **kwargs):
+        if not responses:
+            stop_event.set()
+            return []
+        return original_get_updates(*args, **kwargs)
+
+    bot.get_updates = get_updates
+    with bot:
+        bot.start(stop_event=stop_event, timeout=0)
+    assert not responses
+
+
+def test_api_raises_request_exception_for_non_json_response(monkeypatch):
+    monkeypatch.setattr(catbot._TelegramAdapter, 'send', fake_send([(502, b'<html>502 Bad Gateway</html>')]))
+    bot = catbot.Bot(config={'token': '1:x'})
+    with pytest.raises(requests.RequestException):
+        bot.api('getUpdates', {})
+
+
+def test_identity_cache_write_failure_is_ignored(monkeypatch, tmp_path):
+    monkeypatch.setattr(catbot._TelegramAdapter, 'send', fake_send([]))
+    bot = catbot.Bot(config={'token': '1:x', 'record': str(tmp_path / 'missing' / 'rec.json')})
+    assert bot.username == 'catbot'
@@ -0,0 +1,13 @@
+import catbot
+
+
+def test_inline_keyboard_round_trip_3x4():
+    markup = {'inline_keyboard': [
+        [{'text': f'{row}-{col}', 'url': '', 'callback_data': f'{row}:{col}'} for col in range(4)]
+        for row in range(3)
+    ]}
+    keyboard = catbot.InlineKeyboard.from_json(markup)
+
+    assert [len(row) for row in keyboard.key_list] == [4, 4, 4]
+    assert keyboard.key_list[2][3].callback_data == '2:3'
+    assert keyboard.parse() == markup